@@ -1,8 +1,105 @@
 # Parses an e-book or other kind of HTML input to various elements
 
 import os
+import re
 import argparse
-from bs4 import BeautifulSoup
+from lxml import etree
+from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
+
+# Chapter outputs are independent, so they are written concurrently with large write buffers
+N_THREADS = 8
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def element_text(elem: etree._Element) -> list:
+    # Like BeautifulSoup's .strings, leave out the contents of scripts and stylesheets
+    etree.strip_elements(elem, "script", "style", with_tail=False)
+    return list(elem.itertext())
+
+
+def parse_streaming(
+    input_fn: str,
+    title_tag: str,
+    chapter_tag: str
+) -> tuple:
+    title = None
+    chapters = []
+    open_chapters = []
+
+    # Stream through the document with lxml, handling each element as soon as it is closed. Chapters are
+    # cleared once extracted, so memory stays bounded by a single chapter instead of the whole book. The input is
+    # decoded as UTF-8 like everywhere else, libxml2 would otherwise fall back to Latin-1 without a <meta charset>.
+
+    with open(input_fn, "rb") as f:
+        for event, elem in etree.iterparse(f, events=("start", "end"), tag=("div", title_tag), html=True, encoding="utf-8"):
+            is_chapter = elem.tag == "div" and chapter_tag in (elem.get("id") or "")
+
+            if event == "start":
+                # Reserve the chapter's slot when it opens, to keep document order with nested chapters
+                if is_chapter:
+                    open_chapters.append(len(chapters))
+                    chapters.append(None)
+                continue
+
+            if elem.tag == title_tag and title is None:
+                title = "\n".join(element_text(elem))
+
+            if is_chapter:
+                chapters[open_chapters.pop()] = "".join(element_text(elem))
+
+                # Chapters nested inside another chapter are still needed for the enclosing chapter's text
+                if len(open_chapters) > 0:
+                    continue
+
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+    return title, chapters
+
+
+def parse_soup(
+    input_fn: str,
+    title_tag: str,
+    chapter_tag: str
+) -> tuple:
+    with open(input_fn, "r", encoding="utf-8") as f:
+        html = f.read()
+
+    # Only build the parts of the tree we are interested in, the rest of the document is skipped while parsing
+
+    chapter_id = re.compile(re.escape(chapter_tag))
+
+    title_strainer = SoupStrainer(title_tag)
+    chapter_strainer = SoupStrainer("div", id=chapter_id)
+
+    # Parse title
+
+    soup = BeautifulSoup(html, "html.parser", parse_only=title_strainer)
+    title = soup.find(title_tag)
+    if title is not None:
+        title = "\n".join(title.strings)
+
+    # Parsing chapters is slightly more difficult, we need to find a match of the chapter tag within the anchor name
+
+    soup = BeautifulSoup(html, "html.parser", parse_only=chapter_strainer)
+
+    # The parsed tree only holds the chapter divs, the same strainer also finds chapters nested inside other chapters
+    chapters = ["".join(div.strings) for div in soup.find_all(chapter_strainer)]
+
+    return title, chapters
+
+
+def write_chapter(
+    out_fn: str,
+    title_prefix: str,
+    chapter: str
+) -> None:
+    with open(out_fn, "w", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(title_prefix)
+        f.write(chapter)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Parse an HTML file")
@@ -10,42 +107,33 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--chapter-tag", help="The anchor/tag to identify chapters with (default: 'chapter')", default="chapter")
     parser.add_argument("-t", "--title-tag", help="The anchor/tag to identify titles with (default: h1)", default="h1")
     parser.add_argument("-o", "--output", help="The output directory to write to (default: _output)", default="_output")
+    parser.add_argument("--safe-parser", action="store_true", help="Parse the whole document with BeautifulSoup and the built-in html.parser instead of streaming it with lxml (slower, for inputs that lxml parses differently)")
     args = parser.parse_args()
 
     if not os.path.isfile(args.input):
         print(f"The input file {args.input} does not exist.")
         exit(2)
 
-    with open(args.input, "r") as f:
-        soup = BeautifulSoup(f.read(), "html.parser")
+    if args.safe_parser:
+        title, chapters = parse_soup(args.input, args.title_tag, args.chapter_tag)
+    else:
+        title, chapters = parse_streaming(args.input, args.title_tag, args.chapter_tag)
 
-    # Parse title
-
-    title = list(soup.find(args.title_tag).strings)
-    title = "\n".join(title)
-
-    # Parsing chapters is slightly more difficult, we need to find a match of the chapter tag within the anchor name
-
-    chapters = []
-
-    divs = soup.find_all("div")
-    for div in divs:
-        if "id" in div.attrs and args.chapter_tag in div.attrs["id"]:
-            lines = list(div.strings)
-            chapters.append("".join(lines))
+    if title is None:
+        print(f"No title tag '{args.title_tag}' found in {args.input}.")
+        exit(2)
 
     if not os.path.isdir(args.output):
         os.makedirs(args.output)
 
     # Generate text outputs
 
-    for i, chapter in enumerate(chapters):
-        out_fn = os.path.join(args.output, f"chapter_{i+1}.txt")
-
-        output = "\n".join([title, chapter])
+    title_prefix = title + "\n"
+    out_fns = [os.path.join(args.output, f"chapter_{i+1}.txt") for i in range(len(chapters))]
 
-        with open(out_fn, "w") as f:
-            f.write(output)
+    with ThreadPoolExecutor(N_THREADS) as executor:
+        # Consume the results so that any write error is raised here
+        list(executor.map(write_chapter, out_fns, [title_prefix] * len(chapters), chapters))
 
     print(f"Successfully parsed {len(chapters)} chapters for '{args.input}', outputs in '{args.output}' directory.")
     exit(0)
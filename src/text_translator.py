@@ -1,64 +1,241 @@
 # Translate text from one language to another using Azure Cognitive Services
 
 import os
+import time
 import uuid
+import orjson
+import hashlib
 import argparse
 import requests
 from glob import glob
 from tqdm import tqdm
+from threading import Lock
+from urllib.parse import urljoin, urlencode
 from functools import partial
-from multiprocessing.pool import ThreadPool as Pool
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 
 
-def process_single_file(
-    input_fn: str,
-    output_dir: str,
+# Azure Translator accepts up to 100 array elements and 50,000 characters per request, where the characters are
+# counted once per target language. Leave some headroom on the character count for JSON and encoding overhead.
+MAX_BATCH_ITEMS = 100
+MAX_BATCH_CHARS = 45000
+
+# Large enough to hold a whole translated output, so each file is written with a single write call
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Access tokens issued by Azure are valid for 10 minutes, we renew them after 9 minutes at the latest
+TOKEN_TTL = 540
+TOKEN_REFRESH_MARGIN = 30
+
+# Connect and read timeouts in seconds, so that a hung connection can't stall a worker forever
+CONNECT_TIMEOUT = 10
+REQUEST_TIMEOUT = (CONNECT_TIMEOUT, 60)
+
+# Azure requests are pure network I/O, so far more of them can be in flight than there are CPU cores.
+# The connection pool of the shared HTTP session must be at least as large as the number of workers.
+MAX_WORKERS = 32
+
+
+def create_session(pool_maxsize: int = MAX_WORKERS) -> requests.Session:
+    # Share one session between all workers so that connections to Azure are kept alive and reused. Throttled
+    # (429) and transient server errors are retried with exponential backoff, including for the POST requests.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "POST"]
+        )
+    ))
+    return session
+
+
+class TokenCache:
+    # Caches the access token used with --auth_mode token, shared by all workers. The lock makes sure that
+    # only one worker issues a new token when it expires, while the others wait for it.
+
+    def __init__(self, session: requests.Session, issue_url: str, azure_key: str, timeout: tuple = REQUEST_TIMEOUT):
+        self.session = session
+        self.issue_url = issue_url
+        self.azure_key = azure_key
+        self.timeout = timeout
+        self.lock = Lock()
+        self.token = None
+        self.expiry = 0
+
+    def get_token(self) -> str:
+        with self.lock:
+            if self.token is None or self.expiry - time.monotonic() < TOKEN_REFRESH_MARGIN:
+                request = self.session.post(self.issue_url, headers={"Ocp-Apim-Subscription-Key": self.azure_key}, timeout=self.timeout)
+                if request.status_code >= 400:
+                    raise Exception(f"Error issuing access token: Code {request.status_code}, {request.text}")
+                self.token = request.text
+                self.expiry = time.monotonic() + TOKEN_TTL
+            return self.token
+
+    def invalidate(self, token: str) -> None:
+        # Only drop the token if no other worker has already replaced it
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+
+def read_text(input_fn: str) -> str:
+    # Read the whole file as bytes and decode it in a single pass, skipping the text stream's newline translation
+    with open(input_fn, "rb") as f:
+        return f.read().decode("utf-8")
+
+
+def chunk_text(
+    text: str,
+    limit: int = MAX_BATCH_CHARS
+) -> list:
+    # Split the text at paragraph boundaries into chunks of at most limit characters, so that long chapters fit
+    # into a single request. A paragraph that is longer than the limit on its own is cut at the last whitespace
+    # before the limit, or right at the limit if there is none (e.g. CJK text). Each chunk is returned together
+    # with the separator that preceded it, so joining them back together restores the original layout.
+
+    pieces = []
+    for i, paragraph in enumerate(text.split("\n\n")):
+        separator = "\n\n" if i > 0 else ""
+        while len(paragraph) > limit:
+            cut = max(paragraph.rfind("\n", 0, limit), paragraph.rfind(" ", 0, limit))
+            if cut <= 0:
+                pieces.append((paragraph[:limit], separator))
+                separator = ""
+                paragraph = paragraph[limit:]
+            else:
+                pieces.append((paragraph[:cut], separator))
+                separator = paragraph[cut]
+                paragraph = paragraph[cut + 1:]
+        pieces.append((paragraph, separator))
+
+    chunks = []
+    chunk = []
+    chunk_separator = ""
+    n_chars = 0
+
+    for piece, separator in pieces:
+        if len(chunk) > 0 and n_chars + len(separator) + len(piece) > limit:
+            chunks.append(("".join(chunk), chunk_separator))
+            chunk = []
+            n_chars = 0
+        if len(chunk) == 0:
+            chunk_separator = separator
+        else:
+            chunk.append(separator)
+            n_chars += len(separator)
+        chunk.append(piece)
+        n_chars += len(piece)
+
+    chunks.append(("".join(chunk), chunk_separator))
+
+    return chunks
+
+
+def make_batches(
+    segments: list,
+    batch_items: int = MAX_BATCH_ITEMS,
+    batch_chars: int = MAX_BATCH_CHARS
+) -> list:
+    batches = []
+    batch = []
+    n_chars = 0
+
+    for segment in segments:
+        _, input_text = segment
+
+        # Flush the current batch if adding this segment would exceed either limit
+
+        if len(batch) > 0 and (len(batch) >= batch_items or n_chars + len(input_text) > batch_chars):
+            batches.append(batch)
+            batch = []
+            n_chars = 0
+
+        batch.append(segment)
+        n_chars += len(input_text)
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    return batches
+
+
+def process_batch(
+    batch: list,
+    session: requests.Session,
     call_url: str,
-    params: dict,
     headers: dict,
+    token_cache: TokenCache = None,
+    timeout: tuple = REQUEST_TIMEOUT,
     debug: bool = False
 ) -> dict:
-    res = {'status': 0, 'message': "Success"}
+    res = {'status': 0, 'message': "Success", 'translations': []}
+
+    # Encode the body ourselves with orjson, which produces UTF-8 bytes directly (without \u escapes)
+
+    body = orjson.dumps([{'text': input_text} for _, input_text in batch])
+
+    # Call the Azure API, with a trace id per request. With token authentication, a rejected token is
+    # dropped from the cache and the request is retried once with a freshly issued one.
 
-    with open(input_fn, "r") as f:
-        input_text = f.read()
+    for attempt in range(2):
+        request_headers = {**headers, "X-ClientTraceId": str(uuid.uuid4())}
+        if token_cache is not None:
+            token = token_cache.get_token()
+            request_headers["Authorization"] = f"Bearer {token}"
 
-    body = [{
-        'text': input_text
-    }]
+        request = session.post(call_url, headers=request_headers, data=body, timeout=timeout)
 
-    # Call the Azure API
+        if token_cache is None or request.status_code not in (401, 403) or attempt > 0:
+            break
+        token_cache.invalidate(token)
 
-    request = requests.post(call_url, params=params, headers=headers, json=body)
-    response = request.json()
+    response = orjson.loads(request.content)
 
     if 'error' in response:
         res['status'] = response['error']['code']
         res['message'] = response['error']['message']
-        raise Exception(f"Error processing {input_fn}: Code {res['status']}, {res['message']}")
+        raise Exception(f"Error processing a batch of {len(batch)} segments: Code {res['status']}, {res['message']}")
+
+    # The response array is index-aligned with the request body, collect the translations per segment and language
+
+    for (key, _), result in zip(batch, response):
+        translations = {translation["to"]: translation["text"] for translation in result["translations"]}
+        res['translations'].append((key, translations))
+
+    if debug:
+        print(f"Successfully translated a batch of {len(batch)} segments")
+
+    return res
 
-    # Ready for output
 
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir, exist_ok=True)  # To work with multiprocessing
+def write_translations(
+    input_fn: str,
+    chunks: list,
+    output_dir: str,
+    debug: bool = False
+) -> None:
     base, ext = os.path.splitext(os.path.basename(input_fn))
 
-    # Write the output per language
+    # Join the translated chunks back together with their original separators and write the output per language
 
-    for translation in response[0]["translations"]:
-        lang = translation["to"]
-        translated_text = translation["text"]
+    for lang in chunks[0][0]:
+        translated_text = "".join(separator + translations[lang] for translations, separator in chunks)
 
         out_fn = os.path.join(output_dir, f"{base}_{lang}{ext}")
 
-        with open(out_fn, "w") as f:
+        with open(out_fn, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
             f.write(translated_text)
 
         if debug:
             print(f"Successfully written {out_fn}")
 
-    return res
-
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Translate text from one language to another using Azure Cognitive Services")
@@ -68,6 +245,11 @@ if __name__ == "__main__":
     parser.add_argument("-t", "--target", nargs="*", help="The target language(s) to translate to (default: zh-Hans)", default=["zh-Hans"])
     parser.add_argument("--azure_region", help="The Azure region to use (default: northeurope)", default="northeurope")
     parser.add_argument("--azure_endpoint", help="The Azure endpoint to use (default: https://api.cognitive.microsofttranslator.com)", default="https://api.cognitive.microsofttranslator.com")
+    parser.add_argument("--auth_mode", choices=["key", "token"], help="Authenticate every request with the subscription key, or with access tokens issued for it (default: key)", default="key")
+    parser.add_argument("--batch_items", type=int, help=f"The maximum number of text segments to send per request (default: {MAX_BATCH_ITEMS})", default=MAX_BATCH_ITEMS)
+    parser.add_argument("--batch_chars", type=int, help=f"The maximum number of characters to send per request, counted across all target languages, longer files are split at paragraphs (default: {MAX_BATCH_CHARS})", default=MAX_BATCH_CHARS)
+    parser.add_argument("--request_timeout", type=float, help=f"The read timeout in seconds for translation requests (default: {REQUEST_TIMEOUT[1]})", default=REQUEST_TIMEOUT[1])
+    parser.add_argument("--max_workers", type=int, help=f"The maximum number of concurrent requests to Azure (default: {MAX_WORKERS})", default=MAX_WORKERS)
     parser.add_argument("--debug", action="store_true", help="Debug mode")
     args = parser.parse_args()
 
@@ -80,19 +262,16 @@ if __name__ == "__main__":
     azure_key = os.getenv("TRANSLATOR_KEY")
 
     azure_endpoint = args.azure_endpoint
-    call_url = os.path.join(azure_endpoint, "translate")
+    call_url = urljoin(azure_endpoint.rstrip("/") + "/", "translate")
 
-    params = {
-        "api-version": "3.0",
-        "from": args.source,
-        "to": args.target
-    }
+    # The query parameters are the same for every request, so encode them into the URL once
+
+    params = [("api-version", "3.0"), ("from", args.source)] + [("to", target) for target in args.target]
+    call_url = f"{call_url}?{urlencode(params)}"
 
     headers = {
-        "Ocp-Apim-Subscription-Key": azure_key,
         "Ocp-Apim-Subscription-Region": args.azure_region,
-        "Content-type": "application/json",
-        "X-ClientTraceId": str(uuid.uuid4())
+        "Content-type": "application/json; charset=utf-8"
     }
 
     # Read the input file/directory
@@ -105,30 +284,62 @@ if __name__ == "__main__":
         print(f"The input {args.input} does not exist.")
         exit(2)
 
+    session = create_session(args.max_workers)
+    request_timeout = (CONNECT_TIMEOUT, args.request_timeout)
+
+    # Access tokens are issued by the regional endpoint, otherwise the subscription key is sent with every request
+
+    token_cache = None
+    if args.auth_mode == "token":
+        token_cache = TokenCache(session, f"https://{args.azure_region}.api.cognitive.microsoft.com/sts/v1.0/issueToken", azure_key, request_timeout)
+    else:
+        headers["Ocp-Apim-Subscription-Key"] = azure_key
+
+    # Azure counts every character once per target language, so the source text of a request gets a share of the limit
+
+    batch_chars = max(1, args.batch_chars // max(1, len(args.target)))
+
+    # Split long files into chunks that fit into a single request. Identical chunks (repeated front matter,
+    # boilerplate etc.) are only sent once, keyed by their hash, and each file keeps the list of its chunk keys.
+
+    segments = {}
+    file_chunks = {}
+    for input_fn in files:
+        file_chunks[input_fn] = []
+        for chunk, separator in chunk_text(read_text(input_fn), batch_chars):
+            key = hashlib.blake2b(chunk.encode("utf-8"), digest_size=16).digest()
+            segments.setdefault(key, chunk)
+            file_chunks[input_fn].append((key, separator))
+
+    # Coalesce the unique chunks of all files into as few requests as the Azure limits allow
+
+    batches = make_batches(list(segments.items()), args.batch_items, batch_chars)
+
     if args.debug:
         res = []
-        for file in tqdm(files, ascii=True, desc="Processing files"):
+        for batch in tqdm(batches, ascii=True, desc="Processing batches"):
             res.append(
-                process_single_file(
-                    file,
-                    args.output,
+                process_batch(
+                    batch,
+                    session,
                     call_url,
-                    params,
                     headers,
+                    token_cache,
+                    request_timeout,
                     args.debug
                 )
             )
     else:
-        with Pool() as p:
-            res = list(tqdm(p.imap_unordered(
+        with ThreadPoolExecutor(args.max_workers) as executor:
+            res = list(tqdm(executor.map(
                 partial(
-                    process_single_file,
-                    output_dir=args.output,
+                    process_batch,
+                    session=session,
                     call_url=call_url,
-                    params=params,
-                    headers=headers
-                ), files), total=len(files), ascii=True, desc="Processing files"))
-        p.join()
+                    headers=headers,
+                    token_cache=token_cache,
+                    timeout=request_timeout
+                ), batches), total=len(batches), ascii=True, desc="Processing batches"))
 
     # Check results
 
@@ -137,5 +348,19 @@ if __name__ == "__main__":
             print(f"Error: {item['message']}")
             exit(2)
 
-    print(f"Successfully translated {len(res)} files from '{args.input}', outputs in '{args.output}' directory.")
+    # Reassemble the translated chunks per file and write the outputs
+
+    translated_chunks = {}
+    for item in res:
+        for key, translations in item['translations']:
+            translated_chunks[key] = translations
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    for input_fn in files:
+        chunks = [(translated_chunks[key], separator) for key, separator in file_chunks[input_fn]]
+        write_translations(input_fn, chunks, args.output, args.debug)
+
+    print(f"Successfully translated {len(files)} files from '{args.input}', outputs in '{args.output}' directory.")
     exit(0)
@@ -1,20 +1,29 @@
 # Create long-form text-to-speech synthesis from text chapters using Azure Cognitive Services
 
 import os
-import uuid
 import json
 import time
+import random
 import shutil
+import orjson
 import zipfile
 import requests
 import argparse
+import threading
+import tempfile
 import traceback
+from collections import deque
 from glob import glob
 from tqdm import tqdm
 from functools import partial
+from urllib.parse import urljoin
+from xml.sax.saxutils import escape
 import azure.cognitiveservices.speech as speechsdk
-from multiprocessing.pool import ThreadPool as Pool
-from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
 # From https://learn.microsoft.com/en-us/azure/cognitive-services/speech-service/rest-text-to-speech?tabs=streaming#audio-outputs
 OUTPUT_AUDIO_FORMAT = "audio-48khz-192kbitrate-mono-mp3"
@@ -23,96 +32,230 @@ OUTPUT_AUDIO_FORMAT = "audio-48khz-192kbitrate-mono-mp3"
 THREADPOOL_TIMEOUT = 900
 N_THREADS = 4
 
-
+# Job status polling starts after 2 seconds and backs off exponentially by 1.5x, up to once every 30 seconds per job
+POLL_MIN_DELAY = 2
+POLL_MAX_DELAY = 30
+POLL_BACKOFF_FACTOR = 1.5
+
+# Downloads are copied from the network to disk in 1 MiB blocks, through a larger 4 MiB write buffer
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_BUFFER_SIZE = 4 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Connect and read timeouts in seconds, so that a hung connection can't stall a worker forever
+CONNECT_TIMEOUT = 10
+REQUEST_TIMEOUT = (CONNECT_TIMEOUT, 60)
+DOWNLOAD_TIMEOUT = (CONNECT_TIMEOUT, 600)
+
+# Maximum number of entries extracted concurrently from one archive
+N_UNZIP_THREADS = 8
+
+# Throttled and transient server errors are worth retrying, both per request and per submission
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# A failed submission is retried up to 5 times in total, waiting exponentially longer in between up to 30 seconds
+SUBMIT_ATTEMPTS = 5
+SUBMIT_MAX_WAIT = 30
+
+# Azure requests are pure network I/O, so far more of them can be in flight than there are CPU cores.
+# The connection pool of the shared HTTP session must be at least as large as the number of workers.
+MAX_WORKERS = 32
+
+# Cap the number of Azure API calls in flight across all workers to stay under the per-subscription rate limits
+MAX_CONCURRENT_REQUESTS = 16
+azure_semaphore = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+# Realtime synthesizers are kept per worker thread and reused across files. A synthesizer handles one request at a
+# time, so each worker thread keeps a few of them to overlap the chunks of a file, with one request in flight on each.
+N_SYNTHESIZERS = 4
+thread_local = threading.local()
+
+
+def create_session(pool_maxsize: int = MAX_WORKERS) -> requests.Session:
+    # Share one session between all workers so that connections to Azure are kept alive and reused. Throttled
+    # (429) and transient server errors are retried with exponential backoff for the idempotent requests. Submissions
+    # (POST) are only retried here if the connection failed before the request was sent, their error responses are
+    # retried by submit_single_file instead, so the two retry layers never multiply.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=["HEAD", "GET"]
+        )
+    ))
+    return session
+
+
+class SubmissionError(Exception):
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_retryable(exception: BaseException) -> bool:
+    # Throttled or transient server errors are worth another try. Network errors are final: connection failures have
+    # already been retried by the session, and a read timeout may mean the job was created, so resubmitting it could
+    # start a duplicate (billed) job.
+    return isinstance(exception, SubmissionError) and exception.status_code in RETRY_STATUS_CODES
+
+
+@retry(
+    stop=stop_after_attempt(SUBMIT_ATTEMPTS),
+    wait=wait_exponential(multiplier=1, max=SUBMIT_MAX_WAIT),
+    retry=retry_if_exception(is_retryable),
+    reraise=True
+)
 def submit_single_file(
     input_fn: str,
+    session: requests.Session,
     call_url: str,
-    config: dict,
+    static_payload: dict,
     headers: dict,
+    timeout: tuple = REQUEST_TIMEOUT,
     debug: bool = False
 ) -> dict:
     res = {'status': 0, 'message': "Success", 'job_id': None}
 
-    with open(input_fn, "r") as f:
-        input_text = f.read()
+    with open(input_fn, "rb") as f:
+        input_text = f.read().decode("utf-8")
+
+    # Only the description and the input text differ between files, the rest of the payload is shared
 
     payload = {
-        'displayName': "Text to Voice Synthesis Batch Job",
+        **static_payload,
         'description': input_fn,
-        'textType': "PlainText",
-        'synthesisConfig': config,
         'inputs': [{
             'text': input_text
         }],
-        'properties': {
-            'outputFormat': OUTPUT_AUDIO_FORMAT
-        },
     }
 
     # Call the Azure API
 
-    request = requests.post(call_url, headers=headers, json=payload)
-    response = request.json()
+    with azure_semaphore:
+        request = session.post(call_url, headers=headers, data=orjson.dumps(payload), timeout=timeout)
 
     if request.status_code < 400:
-        res['job_id'] = response['id']
+        res['job_id'] = orjson.loads(request.content)['id']
         if debug:
             print(f"Successfully submitted {input_fn}, job_id: {res['job_id']}")
         return res
 
-    res['status'] = request.status_code
-    res['message'] = f"Error submitting {input_fn} to batch synthesis: {request.text}"
-    raise Exception(f"Error processing {input_fn}: Code {res['status']}, {res['message']}")
+    raise SubmissionError(f"Error submitting {input_fn} to batch synthesis: Code {request.status_code}, {request.text}", request.status_code)
 
 
-def check_job_status(
-    job_id: str,
+def parse_job_status(job: dict) -> dict:
+    res = {'status': job['status'], 'uri': None, 'input_fn': job.get('description')}
+
+    if res['status'] == "Succeeded":
+        res['uri'] = job['outputs']['result']
+
+    return res
+
+
+class ListJobsError(Exception):
+    pass
+
+
+def list_jobs(
+    session: requests.Session,
     call_url: str,
     headers: dict,
+    timeout: tuple = REQUEST_TIMEOUT,
     debug: bool = False
 ) -> dict:
-    res = {'status': "", 'uri': None, 'input_fn': None}
+    jobs = {}
 
-    # Call the Azure API
+    # Call the Azure API, following the pagination links until all jobs have been listed
 
-    request = requests.get(f"{call_url}/{job_id}", headers=headers)
-    response = request.json()
+    url = call_url
+    params = {'top': 100}
 
-    if request.status_code < 400:
-        res['status'] = response['status']
-        if res['status'] == "Succeeded":
-            res['uri'] = response['outputs']['result']
-            res['input_fn'] = response['description']
-        if debug:
-            print(f"Status for {job_id}: {res['status']}, uri: {res['uri']}, input_fn: {res['input_fn']}")
-        return res
+    while url is not None:
+        with azure_semaphore:
+            request = session.get(url, headers=headers, params=params, timeout=timeout)
 
-    res['status'] = f"Error checking the status of job_id: {job_id}: {request.text}"
-    return res
+        if request.status_code >= 400:
+            raise ListJobsError(f"Error listing batch synthesis jobs: Code {request.status_code}, {request.text}")
+
+        response = orjson.loads(request.content)
+
+        for job in response['values']:
+            jobs[job['id']] = parse_job_status(job)
+
+        url = response.get('@nextLink')
+        params = None   # The next link already carries the paging parameters
+
+    if debug:
+        print(f"Listed {len(jobs)} batch synthesis jobs")
+
+    return jobs
+
+
+def drop_page_cache(f) -> None:
+    # Finished outputs are not read again by us, so advise the OS to evict them from the page cache instead of
+    # letting multi-GB downloads push out more useful pages. Dirty pages can't be evicted, so the data is written
+    # back first. Only available on POSIX systems.
+    if hasattr(os, "posix_fadvise"):
+        f.flush()
+        os.fdatasync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def extract_entry(
+    zip_fn: str,
+    file_info: zipfile.ZipInfo,
+    out_fn: str,
+    tmp_dir: str = None
+) -> None:
+    # Each worker reads the archive through its own handle, so entries can be extracted concurrently. The entry is
+    # written next to its final name and then renamed, so a half-written file never appears under the final name.
+    partial_fn = f"{out_fn}.partial"
+
+    if tmp_dir is None:
+        with zipfile.ZipFile(zip_fn, 'r') as zip_ref:
+            with zip_ref.open(file_info) as src, open(partial_fn, "wb") as dst:
+                shutil.copyfileobj(src, dst, WRITE_BUFFER_SIZE)
+                drop_page_cache(dst)
+    else:
+        # Extract to the (faster) scratch directory first. Moving it next to the final name is a plain rename
+        # when both are on the same filesystem, otherwise the file is copied over once.
+        with zipfile.ZipFile(zip_fn, 'r') as zip_ref:
+            with zip_ref.open(file_info) as src, tempfile.NamedTemporaryFile(dir=tmp_dir, suffix=".partial", delete=False) as dst:
+                shutil.copyfileobj(src, dst, WRITE_BUFFER_SIZE)
+        shutil.move(dst.name, partial_fn)
+
+        with open(partial_fn, "rb") as f:
+            drop_page_cache(f)
+
+    os.replace(partial_fn, out_fn)
 
 
 def unzip_file(
     zip_fn: str,
     output_dir: str,
     filter_ext: str = ".mp3",
+    tmp_dir: str = None,
     debug: bool = False
 ) -> dict:
     res = {'status': 0, 'message': "Success"}
 
     try:
-        # Unzip the file, filtering for the desired extension
+        # Unzip the file, filtering for the desired extension. Entries are extracted within the output directory,
+        # unless a scratch directory is given.
         with zipfile.ZipFile(zip_fn, 'r') as zip_ref:
-            i = 0
-            for file_info in zip_ref.infolist():
-                if file_info.filename.endswith(filter_ext):
-                    temp_dir = os.path.join(output_dir, str(uuid.uuid4()))
-                    out_fn = zip_fn.replace(".zip", f"{filter_ext}")
-                    if i > 0:
-                        out_fn = out_fn.replace(filter_ext, f"_{i}{filter_ext}")
-                    zip_ref.extract(file_info, temp_dir)
-                    shutil.move(os.path.join(temp_dir, file_info.filename), out_fn)
-                    shutil.rmtree(temp_dir)
-                    i += 1
+            entries = [file_info for file_info in zip_ref.infolist() if file_info.filename.endswith(filter_ext)]
+
+        base = os.path.splitext(zip_fn)[0]
+        out_fns = [f"{base}{filter_ext}" if i == 0 else f"{base}_{i}{filter_ext}" for i in range(len(entries))]
+
+        if len(entries) > 0:
+            with ThreadPoolExecutor(min(N_UNZIP_THREADS, len(entries))) as executor:
+                # Consume the results so that any extraction error is raised here
+                list(executor.map(extract_entry, [zip_fn] * len(entries), entries, out_fns, [tmp_dir] * len(entries)))
 
         # Remove the original zip file
         os.remove(zip_fn)
@@ -126,12 +269,36 @@ def unzip_file(
     return res
 
 
+def is_downloaded(
+    session: requests.Session,
+    uri: str,
+    out_fn: str,
+    timeout: tuple = REQUEST_TIMEOUT
+) -> bool:
+    # A previous (interrupted) run may have left the result on disk already. It only counts as downloaded if its
+    # size matches the remote Content-Length, which a HEAD request fetches without transferring the body. If the
+    # check itself fails, the file is simply downloaded again.
+    if not os.path.isfile(out_fn):
+        return False
+
+    try:
+        request = session.head(uri, timeout=timeout, allow_redirects=True)
+        remote_size = request.headers.get("Content-Length")
+        return request.status_code < 400 and remote_size is not None and int(remote_size) == os.path.getsize(out_fn)
+    except (requests.RequestException, ValueError):
+        return False
+
+
 def download_file(
     job_id: str,
+    session: requests.Session,
     uri: str,
     input_fn: str,
     output_dir: str,
+    unzip_executor: ThreadPoolExecutor = None,
     skip_unzip: bool = False,
+    tmp_dir: str = None,
+    timeout: tuple = DOWNLOAD_TIMEOUT,
     debug: bool = False
 ) -> dict:
     res = {'status': 0, 'message': "Success"}
@@ -142,38 +309,80 @@ def download_file(
     out_ext = os.path.splitext(uri.split("?", 1)[0])[1]
     out_fn = os.path.join(output_dir, f"{base}_voice_synthesis{out_ext}")
 
-    print(f"Downloading job {job_id} from {uri} to {out_fn}...")
+    unzip = not skip_unzip and out_ext == ".zip"
 
-    # Call the Azure API
+    # The archive is only removed once all of its entries have been extracted, so finding the first extracted output
+    # without the archive means that a previous run has already completed this job
 
-    request = requests.get(uri)
-    response = request.content
+    extracted_fn = os.path.join(output_dir, f"{base}_voice_synthesis.mp3")
+    if unzip and not os.path.isfile(out_fn) and os.path.isfile(extracted_fn):
+        print(f"Job {job_id} has already been downloaded and extracted to {extracted_fn}, skipping the download")
+        return res
 
-    if request.status_code < 400:
+    if is_downloaded(session, uri, out_fn, timeout):
+        print(f"Job {job_id} has already been downloaded to {out_fn}, skipping the download")
+    else:
+        print(f"Downloading job {job_id} from {uri} to {out_fn}...")
+
+        # Call the Azure API, streaming the response body straight to disk instead of holding it in memory
+
+        with session.get(uri, stream=True, timeout=timeout) as request:
 
-        # Save the file
+            if request.status_code >= 400:
+                res['status'] = request.status_code
+                res['message'] = f"Error downloading job {job_id} from {uri} to {out_fn}: {request.text}"
+                return res
 
-        if not os.path.isdir(output_dir):
-            os.makedirs(output_dir, exist_ok=True)  # To work with multiprocessing
+            # Save the file
 
-        with open(out_fn, "wb") as f:
-            f.write(response)
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir, exist_ok=True)  # To work with multiprocessing
+
+            # Let urllib3 undo any Content-Encoding of the response, so the file on disk is the actual archive
+            request.raw.decode_content = True
+
+            with open(out_fn, "wb", buffering=DOWNLOAD_BUFFER_SIZE) as f:
+                shutil.copyfileobj(request.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+                if not unzip:
+                    drop_page_cache(f)   # An archive is kept cached, it is read back right away for extraction
 
         if debug:
             print(f"Successfully downloaded job {job_id} to {out_fn}")
 
-        if not skip_unzip and out_ext == ".zip":
-            unzip_res = unzip_file(out_fn, output_dir, debug=debug)
-            if unzip_res['status'] != 0:
-                return unzip_res
+    # Hand the archive off for extraction if there is an executor for it, so that this download slot is
+    # free for the next result while the archive is being unzipped
 
-        return res
+    if unzip:
+        if unzip_executor is not None:
+            res['unzip_task'] = unzip_executor.submit(unzip_file, out_fn, output_dir, tmp_dir=tmp_dir, debug=debug)
+            return res
+        unzip_res = unzip_file(out_fn, output_dir, tmp_dir=tmp_dir, debug=debug)
+        if unzip_res['status'] != 0:
+            return unzip_res
 
-    res['status'] = request.status_code
-    res['message'] = f"Error downloading job {job_id} from {uri} to {out_fn}: {request.text}"
     return res
 
 
+def get_synthesizers(speech_config: speechsdk.SpeechConfig) -> list:
+    # Creating a synthesizer means a new TLS and WebSocket handshake, so each worker thread builds its synthesizers on
+    # first use and keeps them for all following files. The connections are opened right away to be ready for the
+    # first chunks. The connection objects are kept alive alongside their synthesizers, since the SDK crashes when
+    # a synthesizer is used after its opened connection object has been garbage collected.
+    synthesizers = getattr(thread_local, 'synthesizers', None)
+    if synthesizers is None:
+        synthesizers = []
+        connections = []
+        for _ in range(N_SYNTHESIZERS):
+            synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+            connection = speechsdk.Connection.from_speech_synthesizer(synthesizer)
+            connection.open(True)
+            synthesizers.append(synthesizer)
+            connections.append(connection)
+        thread_local.synthesizers = synthesizers
+        thread_local.connections = connections
+    return synthesizers
+
+
 def process_single_file(
     input_fn: str,
     output_dir: str,
@@ -182,27 +391,28 @@ def process_single_file(
     res = {'status': 0, 'message': "Success"}
 
     try:
-        # Read input file into a list of lines
+        # Read the whole input file at once and decode it in a single pass
 
-        with open(input_fn, "r") as f:
-            lines = f.readlines()
+        with open(input_fn, "rb") as f:
+            text = f.read().decode("utf-8")
 
-        # Go through the lines and split them into larger chunks.
+        # Walk the line boundaries and slice the text into larger chunks.
         # Microsoft's own Azure Speech Studio cuts off after 3,000 characters, so we will
         # add a new chunk at the line after 2,500 characters have been reached.
 
         chunks = []
-        chunk = ""
-        for line in lines:
-            if len(chunk) + len(line) > 2500:
-                chunks.append(chunk)
-                chunk = ""
-            chunk += line
-        chunks.append(chunk)
+        start = pos = 0
+        while pos < len(text):
+            end = text.find("\n", pos) + 1 or len(text)
+            if end - start > 2500 and pos > start:
+                chunks.append(text[start:pos])
+                start = pos
+            pos = end
+        chunks.append(text[start:])
 
         # Set up the synthesizer and template SSML
 
-        synthesizer = speechsdk.SpeechSynthesizer(speech_config=config['speech_config'], audio_config=None)
+        synthesizers = get_synthesizers(config['speech_config'])
         ssml_string = f"""
         <speak version="1.0" xmlns="http://www.w3.org/2001/10/synthesis" xml:lang="en-US">
             <voice name="{config['voice'] if 'voice' in config else 'zh-CN-XiaoxiaoNeural'}">
@@ -213,16 +423,44 @@ def process_single_file(
         </speak>
         """
 
-        # Synthesize voice for each chunk in memory, then join them as a single byte stream
-        stream = b""
-        for chunk in chunks:
-            ssml = ssml_string.replace("[TEXT]", chunk)
-            stream += synthesizer.speak_ssml_async(ssml).get().audio_data
+        # Split the template once, the chunks are XML-escaped so characters like & or < can't break the SSML
+        ssml_prefix, ssml_suffix = ssml_string.split("[TEXT]")
+
+        # Keep one chunk in flight on each synthesizer so the requests overlap. Results are collected in the original
+        # order and appended straight to the output file, each freed synthesizer then takes on the next chunk.
         out_fn = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(input_fn))[0]}_voice_synthesis.mp3")
 
-        # Save the stream to a file
-        with open(out_fn, "wb") as f:
-            f.write(stream)
+        remaining = iter(chunks)
+        pending = deque()
+
+        def synthesize_next(synthesizer: speechsdk.SpeechSynthesizer) -> None:
+            chunk = next(remaining, None)
+            if chunk is not None:
+                pending.append((synthesizer, synthesizer.speak_ssml_async(ssml_prefix + escape(chunk) + ssml_suffix)))
+
+        for synthesizer in synthesizers:
+            synthesize_next(synthesizer)
+
+        try:
+            with open(out_fn, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                while len(pending) > 0:
+                    synthesizer, future = pending.popleft()
+                    result = future.get()
+
+                    # Throttled or otherwise canceled chunks come back without audio instead of raising an error
+                    if result.reason != speechsdk.ResultReason.SynthesizingAudioCompleted:
+                        details = result.cancellation_details
+                        raise Exception(f"Synthesis of a chunk was canceled: {details.reason}, {details.error_details}")
+
+                    f.write(result.audio_data)
+                    synthesize_next(synthesizer)
+        finally:
+            # After a failure, wait out the requests still in flight so they can't hold up this thread's next file
+            for _, future in pending:
+                try:
+                    future.get()
+                except:
+                    pass
     except:
         res['status'] = 2
         res['message'] = f"Error processing {input_fn}: {traceback.format_exc()}"
@@ -237,9 +475,15 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--voice_config", help="The path to voice configuration json (default: cfg/default.json", default="cfg/default.json")
     parser.add_argument("--azure_region", help="The Azure region to use (default: northeurope)", default="northeurope")
     parser.add_argument("--azure_endpoint", help="The Azure endpoint to use (default: customvoice.api.speech.microsoft.com)", default="customvoice.api.speech.microsoft.com")
+    parser.add_argument("--poll_min_delay", type=float, help=f"The initial delay in seconds between job status checks (default: {POLL_MIN_DELAY})", default=POLL_MIN_DELAY)
+    parser.add_argument("--poll_max_delay", type=float, help=f"The maximum delay in seconds between job status checks (default: {POLL_MAX_DELAY})", default=POLL_MAX_DELAY)
+    parser.add_argument("--request_timeout", type=float, help=f"The read timeout in seconds for batch synthesis API requests (default: {REQUEST_TIMEOUT[1]})", default=REQUEST_TIMEOUT[1])
+    parser.add_argument("--download_timeout", type=float, help=f"The read timeout in seconds for downloading batch synthesis results (default: {DOWNLOAD_TIMEOUT[1]})", default=DOWNLOAD_TIMEOUT[1])
+    parser.add_argument("--max_workers", type=int, help=f"The maximum number of concurrent batch synthesis submissions (default: {MAX_WORKERS})", default=MAX_WORKERS)
     parser.add_argument("--debug", action="store_true", help="Debug mode")
     parser.add_argument("--list_only", action="store_true", help="Go straight to jobs listing and download mode")
     parser.add_argument("--no_unzip", action="store_true", help="Do not unzip and rename downloaded files automatically")
+    parser.add_argument("--tmpdir", help="Scratch directory to extract downloaded files in before moving them to the output directory, e.g. a tmpfs mount (default: $AUDIOBOOK_TMPDIR, or extract within the output directory)", default=os.environ.get("AUDIOBOOK_TMPDIR"))
     parser.add_argument("--batch_synthesis", action="store_true", help="Use asynchronous batch synthesis instead of realtime synthesis (your Azure Key must be Standard Paid Tier, not Free Tier)")
     args = parser.parse_args()
 
@@ -273,16 +517,20 @@ if __name__ == "__main__":
     if args.batch_synthesis:
 
         azure_endpoint = f"https://{args.azure_region}.{args.azure_endpoint}"
-        call_url = os.path.join(azure_endpoint, "api/texttospeech/3.1-preview1/batchsynthesis")
+        call_url = urljoin(azure_endpoint.rstrip("/") + "/", "api/texttospeech/3.1-preview1/batchsynthesis")
 
         headers = {
             "Ocp-Apim-Subscription-Key": azure_key,
             "Content-type": "application/json",
         }
 
+        session = create_session(args.max_workers + N_THREADS)   # Submissions and downloads share the session
+        request_timeout = (CONNECT_TIMEOUT, args.request_timeout)
+        download_timeout = (CONNECT_TIMEOUT, args.download_timeout)
+
         if args.list_only:
             print("Listing jobs...")
-            request = requests.get(call_url, headers=headers)
+            request = session.get(call_url, headers=headers, timeout=request_timeout)
             response = request.json()
 
             if request.status_code < 400:
@@ -293,109 +541,189 @@ if __name__ == "__main__":
                 print(f"Error listing batch synthesis jobs: {request.text}")
                 exit(2)
 
-        # Submit the input files to Azure for voice synthesis
+        # Submit the input files to Azure for voice synthesis. Submissions run in the background while the main
+        # thread already starts polling and downloading the jobs that have been submitted so far.
 
-        if args.debug:
-            res = []
-            for file in tqdm(files, ascii=True, desc="Submitting files"):
-                res.append(
-                    submit_single_file(
-                        file,
-                        call_url,
-                        config,
-                        headers,
-                        args.debug
-                    )
-                )
-        else:
-            with Pool() as p:
-                res = list(tqdm(p.imap_unordered(
-                    partial(
-                        submit_single_file,
-                        call_url=call_url,
-                        config=config,
-                        headers=headers
-                    ), files), total=len(files), ascii=True, desc="Submitting files"))
-            p.join()
+        static_payload = {
+            'displayName': "Text to Voice Synthesis Batch Job",
+            'textType': "PlainText",
+            'synthesisConfig': config,
+            'properties': {
+                'outputFormat': OUTPUT_AUDIO_FORMAT
+            },
+        }
 
-        # Collect both successful and failed submissions
+        submit_executor = ThreadPoolExecutor(1 if args.debug else args.max_workers)
+        submit_tasks = {
+            submit_executor.submit(
+                submit_single_file,
+                file,
+                session,
+                call_url,
+                static_payload,
+                headers,
+                request_timeout,
+                args.debug
+            ): file for file in files
+        }
+
+        executor = ThreadPoolExecutor(N_THREADS)
+        unzip_executor = ThreadPoolExecutor(N_THREADS)
 
         successful_submissions = {}
         failed_submissions = []
+        failed_jobs = []
 
-        for item in tqdm(res, ascii=True, desc="Checking submission statuses"):
-            if item['status'] != 0:
-                failed_submissions.append(res['message'])
+        # Each job is polled on its own schedule, growing its delay while it is still running. The delays are
+        # jittered by +-20% so that the jobs don't all come due at the same moment. Jobs submitted together tend to
+        # finish together, so once any job has succeeded, the delays of the remaining jobs are reset.
+
+        next_check = {}
+        backoff = {}
+
+        submit_progress = tqdm(total=len(files), ascii=True, desc="Submitting files")
+
+        while len(submit_tasks) > 0 or len(next_check) > 0:
+
+            # Wait until either a submission completes or the next job status check is due
+
+            timeout = max(0, min(next_check.values()) - time.monotonic()) if len(next_check) > 0 else None
+
+            if len(submit_tasks) > 0:
+                done, _ = wait(submit_tasks, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for task in done:
+                    file = submit_tasks.pop(task)
+                    submit_progress.update()
+
+                    # Submissions that still fail after their retries, or fail in any other way (unreadable input,
+                    # unexpected response), are reported below instead of aborting the run
+                    try:
+                        item = task.result()
+                    except SubmissionError as e:
+                        failed_submissions.append(str(e))
+                        continue
+                    except Exception as e:
+                        failed_submissions.append(f"Error submitting {file} to batch synthesis: {type(e).__name__}: {e}")
+                        continue
+                    # A freshly submitted job is not going to be done yet, its first status check is left to the poller
+                    successful_submissions[item['job_id']] = {'status': "NotStarted", 'uri': None, 'input_fn': None, 'download_task': None}
+                    next_check[item['job_id']] = time.monotonic() + args.poll_min_delay
+                    backoff[item['job_id']] = args.poll_min_delay
+
+                if len(submit_tasks) == 0:
+                    submit_progress.close()
+                    submit_executor.shutdown()
+
+                    # Display failed submissions, if any
+
+                    if len(failed_submissions) > 0:
+                        print(f"Warning! {len(failed_submissions)} failed submissions detected:")
+                        for item in failed_submissions:
+                            print(item)
+
+                    print(f"Successfully submitted {len(successful_submissions)} jobs, waiting for the batch job to complete (be patient, this may take a minute or two)...")
             else:
-                successful_submissions[item['job_id']] = check_job_status(item['job_id'], call_url, headers)
+                time.sleep(timeout)
 
-        # Display failed submissions, if any
+            now = time.monotonic()
+            due = [job_id for job_id, t in next_check.items() if now >= t]
 
-        if len(failed_submissions) > 0:
-            print(f"Warning! {len(failed_submissions)} failed submissions detected:")
-            for item in failed_submissions:
-                print(item)
+            if len(due) == 0:
+                continue
 
-        # Start a loop to check the status of the successful submissions and download via the threadpool executor
+            if args.debug:
+                print(f"Checking voice synthesis job status for {len(due)} due jobs...")
 
-        print(f"Successfully submitted {len(successful_submissions)} jobs, waiting for the batch job to complete (be patient, this may take a minute or two)...")
+            # Fetch the status of all jobs with a single request instead of one request per job, and use it
+            # for every pending job since it costs nothing extra
 
-        executor = ThreadPoolExecutor(N_THREADS)
+            # A failed listing is not fatal, the due jobs keep their last known status and are checked again later
 
-        if len(successful_submissions) > 0:
-            while True:
-                n_success_jobs = 0
-                if args.debug:
-                    print("Checking voice synthesis job status...")
-
-                for job_id in successful_submissions:
-                    if args.debug:
-                        print(f"{job_id}: {successful_submissions[job_id]['status']}")
-                    if successful_submissions[job_id]['status'] == "Succeeded":
-                        if 'download_task' in successful_submissions[job_id]:
-                            n_success_jobs += 1
-                            continue
-                        else:
-                            successful_submissions[job_id]['download_task'] = executor.submit(
-                                download_file,
-                                job_id,
-                                successful_submissions[job_id]['uri'],
-                                successful_submissions[job_id]['input_fn'],
-                                args.output,
-                                args.debug
-                            )
-                            n_success_jobs += 1
-                            continue
-                    else:
-                        time.sleep(1)   # To avoid throttling
-                        successful_submissions[job_id] = check_job_status(job_id, call_url, headers)
-
-                # Break the loop if all jobs are successful
-                if n_success_jobs == len(successful_submissions):
-                    break
+            try:
+                jobs = list_jobs(session, call_url, headers, request_timeout)
+            except (ListJobsError, requests.RequestException) as e:
+                print(f"Warning! {e}, checking again later")
+                jobs = {}
 
-                if args.debug:
-                    print("")
+            any_succeeded = False
 
-                time.sleep(10)  # The overall cycle doesn't need to be checked too often, every 10s is more than enough.
+            for job_id in list(next_check):
+                if job_id in jobs:
+                    successful_submissions[job_id] = jobs[job_id]
 
-        # Collect all the download tasks and wait for them to finish
+                if args.debug:
+                    print(f"{job_id}: {successful_submissions[job_id]['status']}")
+
+                if successful_submissions[job_id]['status'] == "Succeeded":
+                    successful_submissions[job_id]['download_task'] = executor.submit(
+                        download_file,
+                        job_id,
+                        session,
+                        successful_submissions[job_id]['uri'],
+                        successful_submissions[job_id]['input_fn'],
+                        args.output,
+                        unzip_executor=unzip_executor,
+                        skip_unzip=args.no_unzip,
+                        tmp_dir=args.tmpdir,
+                        timeout=download_timeout,
+                        debug=args.debug
+                    )
+                    del next_check[job_id]
+                    del backoff[job_id]
+                    any_succeeded = True
+                elif successful_submissions[job_id]['status'] == "Failed":
+                    # A failed job is final, there is nothing to download and no point in checking it again
+                    failed_jobs.append(f"Batch synthesis job {job_id} for {successful_submissions[job_id]['input_fn']} failed")
+                    print(f"Warning! {failed_jobs[-1]}")
+                    del next_check[job_id]
+                    del backoff[job_id]
+                elif job_id in due:
+                    backoff[job_id] = min(args.poll_max_delay, backoff[job_id] * POLL_BACKOFF_FACTOR)
+                    next_check[job_id] = now + backoff[job_id] * random.uniform(0.8, 1.2)
+
+            if any_succeeded:
+                for job_id in next_check:
+                    backoff[job_id] = args.poll_min_delay
+                    next_check[job_id] = now + backoff[job_id] * random.uniform(0.8, 1.2)
+
+            if args.debug:
+                print("")
+
+        # Collect the download results as they complete, followed by the extractions they handed off, and stop at
+        # the first failure instead of waiting for every other task to finish first
 
         download_tasks = []
         for job_id in successful_submissions:
-            download_tasks.append(successful_submissions[job_id]['download_task'])
-
-        download_task_res = wait(download_tasks, timeout=THREADPOOL_TIMEOUT, return_when=FIRST_EXCEPTION)
-
-        if len(download_task_res.not_done) > 0:
-            print(f"Download task timed out after {THREADPOOL_TIMEOUT} seconds.")
+            if successful_submissions[job_id].get('download_task') is not None:
+                download_tasks.append(successful_submissions[job_id]['download_task'])
+
+        unzip_tasks = []
+
+        try:
+            for task in as_completed(download_tasks, timeout=THREADPOOL_TIMEOUT):
+                res = task.result()
+                if res['status'] != 0:
+                    print(res['message'])
+                    exit(res['status'])
+                if 'unzip_task' in res:
+                    unzip_tasks.append(res['unzip_task'])
+
+            for task in as_completed(unzip_tasks, timeout=THREADPOOL_TIMEOUT):
+                res = task.result()
+                if res['status'] != 0:
+                    print(res['message'])
+                    exit(res['status'])
+        except FuturesTimeoutError:
+            print(f"Download or unzip task timed out after {THREADPOOL_TIMEOUT} seconds.")
             exit(2)
 
-        for task_res in download_task_res.done:
-            res = task_res.result()
-            if res['status'] != 0:
-                print(res['message'])
-                exit(res['status'])
+        # Display failed jobs, if any
+
+        if len(failed_jobs) > 0:
+            print(f"Warning! {len(failed_jobs)} failed batch synthesis jobs detected:")
+            for item in failed_jobs:
+                print(item)
 
         print(f"Successfully generated and downloaded {len(download_tasks)} voice syntheses from '{args.input}', outputs in '{args.output}' directory.")
 
@@ -419,18 +747,17 @@ if __name__ == "__main__":
                     )
                 )
         else:
-            with Pool(N_THREADS) as p:
-                res = list(tqdm(p.imap_unordered(
+            with ThreadPoolExecutor(N_THREADS) as executor:
+                res = list(tqdm(executor.map(
                     partial(
                         process_single_file,
                         output_dir=args.output,
                         config=config
                     ), files), total=len(files), ascii=True, desc="Processing files"))
-            p.join()
 
         for item in res:
             if item['status'] != 0:
-                print(res['message'])
-                exit(res['status'])
+                print(item['message'])
+                exit(item['status'])
 
     exit(0)